@@ -168,6 +168,10 @@ ACCELERATE_KEYS_DIR_PERMS      = get_config(p, 'accelerate', 'accelerate_keys_di
 ACCELERATE_KEYS_FILE_PERMS     = get_config(p, 'accelerate', 'accelerate_keys_file_perms', 'ACCELERATE_KEYS_FILE_PERMS', '600')
 ACCELERATE_MULTI_KEY           = get_config(p, 'accelerate', 'accelerate_multi_key', 'ACCELERATE_MULTI_KEY', False, boolean=True)
 PARAMIKO_PTY                   = get_config(p, 'paramiko_connection', 'pty', 'ANSIBLE_PARAMIKO_PTY', True, boolean=True)
+PARAMIKO_COMPRESS              = get_config(p, 'paramiko_connection', 'compress', 'ANSIBLE_PARAMIKO_COMPRESS', False, boolean=True)
+PARAMIKO_WINDOW_SIZE           = get_config(p, 'paramiko_connection', 'window_size', 'ANSIBLE_PARAMIKO_WINDOW_SIZE', 8388608, integer=True)
+PARAMIKO_PACKET_SIZE           = get_config(p, 'paramiko_connection', 'max_packet_size', 'ANSIBLE_PARAMIKO_PACKET_SIZE', 65535, integer=True)
+PARAMIKO_CACHE_SIZE            = get_config(p, 'paramiko_connection', 'cache_size', 'ANSIBLE_PARAMIKO_CACHE_SIZE', 128, integer=True)
 
 # characters included in auto-generated passwords
 DEFAULT_PASSWORD_CHARS = ascii_letters + digits + ".,:-_"
@@ -60,6 +60,9 @@ multiprocessing_runner = None
 OUTPUT_LOCKFILE  = tempfile.TemporaryFile()
 PROCESS_LOCKFILE = tempfile.TemporaryFile()
 
+# result of probing the local ssh for ControlPersist support, see _smart_transport()
+SMART_TRANSPORT = None
+
 ################################################
 
 def _executor_hook(job_queue, result_queue, new_stdin):
@@ -80,6 +83,21 @@ def _executor_hook(job_queue, result_queue, new_stdin):
         except:
             traceback.print_exc()
 
+def _smart_transport():
+    ''' pick ssh if the local ssh supports ControlPersist, otherwise paramiko '''
+
+    # a Runner is created for every task in a playbook, so only fork ssh
+    # to ask once per process
+    global SMART_TRANSPORT
+    if SMART_TRANSPORT is None:
+        cmd = subprocess.Popen(['ssh','-o','ControlPersist'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = cmd.communicate()
+        if "Bad configuration option" in err:
+            SMART_TRANSPORT = "paramiko"
+        else:
+            SMART_TRANSPORT = "ssh"
+    return SMART_TRANSPORT
+
 class HostVars(dict):
     ''' A special view of vars_cache that adds values from the inventory when needed. '''
 
@@ -201,12 +219,7 @@ class Runner(object):
         if self.transport == 'smart':
             # if the transport is 'smart' see if SSH can support ControlPersist if not use paramiko
             # 'smart' is the default since 1.2.1/1.3
-            cmd = subprocess.Popen(['ssh','-o','ControlPersist'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (out, err) = cmd.communicate() 
-            if "Bad configuration option" in err:
-                self.transport = "paramiko"
-            else:
-                self.transport = "ssh" 
+            self.transport = _smart_transport()
 
         # save the original transport, in case it gets
         # changed later via options like accelerate
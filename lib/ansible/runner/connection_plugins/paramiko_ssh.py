@@ -27,11 +27,14 @@ import warnings
 import os
 import pipes
 import socket
-import random
 import logging
 import traceback
 import fcntl
 import sys
+import re
+import contextlib
+import stat
+import tempfile
 from termios import tcflush, TCIFLUSH
 from binascii import hexlify
 from ansible.callbacks import vvv
@@ -45,6 +48,9 @@ The %s key fingerprint is %s.
 Are you sure you want to continue connecting (yes/no)?
 """
 
+# connect errors that get a more helpful message than paramiko's own
+CONNECT_ERROR_RE = re.compile(r'(PID check failed)|(Private key file is encrypted)')
+
 # prevent paramiko warning noise -- see http://stackoverflow.com/questions/3920502/
 HAVE_PARAMIKO=False
 with warnings.catch_warnings():
@@ -56,6 +62,26 @@ with warnings.catch_warnings():
     except ImportError:
         pass
 
+# home directory and expanded key file paths, resolved once per process
+
+HOME_DIR = os.path.expanduser("~")
+EXPANDED_PATHS = {}
+
+def _expanduser(path):
+    expanded = EXPANDED_PATHS.get(path)
+    if expanded is None:
+        expanded = EXPANDED_PATHS[path] = os.path.expanduser(path)
+    return expanded
+
+@contextlib.contextmanager
+def _lockf(fh):
+    ''' hold an exclusive lockf() lock on fh for the duration of a with block '''
+    fcntl.lockf(fh, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.lockf(fh, fcntl.LOCK_UN)
+
 class MyAddPolicy(object):
     """
     Based on AutoAddPolicy in paramiko so we can determine when keys are added
@@ -65,40 +91,43 @@ class MyAddPolicy(object):
     local L{HostKeys} object, and saving it.  This is used by L{SSHClient}.
     """
 
-    def __init__(self, runner): 
+    def __init__(self, runner, connection):
         self.runner = runner
+        self.connection = connection
 
     def missing_host_key(self, client, hostname, key):
 
         if C.HOST_KEY_CHECKING:
 
-            fcntl.lockf(self.runner.process_lockfile, fcntl.LOCK_EX)
-            fcntl.lockf(self.runner.output_lockfile, fcntl.LOCK_EX)
-
-            old_stdin = sys.stdin
-            sys.stdin = self.runner._new_stdin
             fingerprint = hexlify(key.get_fingerprint())
             ktype = key.get_name()
-            
-            # clear out any premature input on sys.stdin
-            tcflush(sys.stdin, TCIFLUSH)
 
-            inp = raw_input(AUTHENTICITY_MSG % (hostname, ktype, fingerprint))
-            sys.stdin = old_stdin
-            if inp not in ['yes','y','']:
-                fcntl.flock(self.runner.output_lockfile, fcntl.LOCK_UN)
-                fcntl.flock(self.runner.process_lockfile, fcntl.LOCK_UN)
-                raise errors.AnsibleError("host connection rejected by user")
+            # only the prompt itself needs to be serialized across forks, the
+            # key exchange with other hosts carries on in parallel meanwhile
+            with _lockf(self.runner.process_lockfile):
+                with _lockf(self.runner.output_lockfile):
 
-            fcntl.lockf(self.runner.output_lockfile, fcntl.LOCK_UN)
-            fcntl.lockf(self.runner.process_lockfile, fcntl.LOCK_UN)
+                    old_stdin = sys.stdin
+                    sys.stdin = self.runner._new_stdin
+                    try:
+                        # clear out any premature input on sys.stdin
+                        tcflush(sys.stdin, TCIFLUSH)
 
+                        inp = raw_input(AUTHENTICITY_MSG % (hostname, ktype, fingerprint))
+                    finally:
+                        sys.stdin = old_stdin
 
-        key._added_by_ansible_this_time = True
+            if inp not in ['yes','y','']:
+                raise errors.AnsibleError("host connection rejected by user")
 
         # existing implementation below:
         client._host_keys.add(hostname, key.get_name(), key)
 
+        # a reconnect within the same task sees the same key again
+        keytype = key.get_name()
+        if (hostname, keytype) not in [ (h, t) for (h, t, k) in self.connection._added_keys ]:
+            self.connection._added_keys.append((hostname, keytype, key))
+
         # host keys are actually saved in close() function below
         # in order to control ordering.
         
@@ -108,6 +137,21 @@ class MyAddPolicy(object):
 SSH_CONNECTION_CACHE = {}
 SFTP_CONNECTION_CACHE = {}
 
+# keys of SSH_CONNECTION_CACHE, least recently used first, so that the number
+# of open transports (and file descriptors) can be bounded
+
+SSH_CONNECTION_LRU = []
+
+def _uncache(cache_key):
+    ''' drop the cached connections for cache_key, returning (ssh, sftp) '''
+    if cache_key in SSH_CONNECTION_LRU:
+        SSH_CONNECTION_LRU.remove(cache_key)
+    return (SSH_CONNECTION_CACHE.pop(cache_key, None), SFTP_CONNECTION_CACHE.pop(cache_key, None))
+
+# parsed known_hosts files, keyed by path, along with the (mtime, size) they were parsed at
+
+SYSTEM_HOST_KEYS_CACHE = {}
+
 class Connection(object):
     ''' SSH based connections with Paramiko '''
 
@@ -122,16 +166,33 @@ class Connection(object):
         self.password = password
         self.private_key_file = private_key_file
         self.has_pipelining = False
+        self._added_keys = []
+
+        # NUL can't appear in any of these, so distinct tuples can't collide.
+        # Interned so repeated cache lookups for a host compare by identity
+        cache_key = "%s\x00%s\x00%s\x00%s" % (self.host, self.user, self.port, self.private_key_file or '')
+        if isinstance(cache_key, str):
+            cache_key = intern(cache_key)
+        self._cache_key_str = cache_key
 
     def _cache_key(self):
-        return "%s__%s__" % (self.host, self.user)
+        return self._cache_key_str
 
     def connect(self):
         cache_key = self._cache_key()
         if cache_key in SSH_CONNECTION_CACHE:
             self.ssh = SSH_CONNECTION_CACHE[cache_key]
+            SSH_CONNECTION_LRU.remove(cache_key)
         else:
             self.ssh = SSH_CONNECTION_CACHE[cache_key] = self._connect_uncached()
+            # a cache_size of 0 or less means no limit
+            while C.PARAMIKO_CACHE_SIZE > 0 and len(SSH_CONNECTION_LRU) >= C.PARAMIKO_CACHE_SIZE:
+                (ssh, sftp) = _uncache(SSH_CONNECTION_LRU[0])
+                if sftp is not None:
+                    sftp.close()
+                if ssh is not None:
+                    ssh.close()
+        SSH_CONNECTION_LRU.append(cache_key)
         return self
 
     def _connect_uncached(self):
@@ -144,36 +205,57 @@ class Connection(object):
 
         ssh = paramiko.SSHClient()
      
-        self.keyfile = os.path.expanduser("~/.ssh/known_hosts")
+        self.keyfile = os.path.join(HOME_DIR, ".ssh", "known_hosts")
 
         if C.HOST_KEY_CHECKING:
             ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(MyAddPolicy(self.runner))
+
+        if C.HOST_KEY_CHECKING or C.PARAMIKO_RECORD_HOST_KEYS:
+            ssh.set_missing_host_key_policy(MyAddPolicy(self.runner, self))
+        else:
+            # keys are neither checked nor recorded, so accept them without
+            # collecting every host's key in memory
+            ssh.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
 
         allow_agent = True
         if self.password is not None:
             allow_agent = False
         try:
             if self.private_key_file:
-                key_filename = os.path.expanduser(self.private_key_file)
+                key_filename = _expanduser(self.private_key_file)
             elif self.runner.private_key_file:
-                key_filename = os.path.expanduser(self.runner.private_key_file)
+                key_filename = _expanduser(self.runner.private_key_file)
             else:
                 key_filename = None
+            connect_args = {}
+            if C.PARAMIKO_COMPRESS:
+                # older paramiko (as shipped with EL6) has no compress argument
+                connect_args['compress'] = True
             ssh.connect(self.host, username=self.user, allow_agent=allow_agent, look_for_keys=True,
                 key_filename=key_filename, password=self.password,
-                timeout=self.runner.timeout, port=self.port)
+                timeout=self.runner.timeout, port=self.port, **connect_args)
         except Exception, e:
             msg = str(e)
-            if "PID check failed" in msg:
+            match = CONNECT_ERROR_RE.search(msg)
+            if match and match.group(1):
                 raise errors.AnsibleError("paramiko version issue, please upgrade paramiko on the machine running ansible")
-            elif "Private key file is encrypted" in msg:
+            elif match and match.group(2):
                 msg = 'ssh %s@%s:%s : %s\nTo connect as a different user, use -u <username>.' % (
                     self.user, self.host, self.port, msg)
                 raise errors.AnsibleConnectionFailed(msg)
             else:
                 raise errors.AnsibleConnectionFailed(msg)
 
+        # a larger window keeps bulk transfers from stalling on the round trip
+        # time of slow links; the attributes were renamed in paramiko 1.15
+        transport = ssh.get_transport()
+        if hasattr(transport, 'default_window_size'):
+            transport.default_window_size = C.PARAMIKO_WINDOW_SIZE
+            transport.default_max_packet_size = C.PARAMIKO_PACKET_SIZE
+        else:
+            transport.window_size = C.PARAMIKO_WINDOW_SIZE
+            transport.max_packet_size = C.PARAMIKO_PACKET_SIZE
+
         return ssh
 
     def exec_command(self, cmd, tmp_path, sudo_user=None, sudoable=False, executable='/bin/sh', in_data=None, su=None, su_user=None):
@@ -183,8 +265,24 @@ class Connection(object):
             raise errors.AnsibleError("Internal Error: this module does not support optimized module pipelining")
 
         bufsize = 4096
+
+        # SSH channels are single-use (one exec per channel), so what we keep
+        # around is the transport.  If the cached transport has gone away
+        # underneath us (server side timeout, network blip), reconnect once
+        # rather than failing every remaining task on this host
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            (ssh, sftp) = _uncache(self._cache_key())
+            if sftp is not None:
+                sftp.close()
+            if ssh is not None:
+                ssh.close()
+            self.sftp = None
+            self.connect()
+            transport = self.ssh.get_transport()
+
         try:
-            chan = self.ssh.get_transport().open_session()
+            chan = transport.open_session()
         except Exception, e:
             msg = "Failed to open session"
             if len(str(e)) > 0:
@@ -233,17 +331,27 @@ class Connection(object):
             except socket.timeout:
                 raise errors.AnsibleError('ssh timed out waiting for sudo.\n' + sudo_output)
 
-        stdout = ''.join(chan.makefile('rb', bufsize))
-        stderr = ''.join(chan.makefile_stderr('rb', bufsize))
+        stdout = self._recv_all(chan.recv)
+        stderr = self._recv_all(chan.recv_stderr)
         return (chan.recv_exit_status(), '', stdout, stderr)
 
+    def _recv_all(self, recv):
+        ''' read a channel stream until EOF in large chunks '''
+        chunks = []
+        while True:
+            data = recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        return ''.join(chunks)
+
     def put_file(self, in_path, out_path):
         ''' transfer a file from local to remote '''
         vvv("PUT %s TO %s" % (in_path, out_path), host=self.host)
         if not os.path.exists(in_path):
             raise errors.AnsibleFileNotFound("file or module does not exist: %s" % in_path)
         try:
-            self.sftp = self.ssh.open_sftp()
+            self.sftp = self._connect_sftp()
         except Exception, e:
             raise errors.AnsibleError("failed to open a SFTP connection (%s)" % e)
         try:
@@ -252,7 +360,7 @@ class Connection(object):
             raise errors.AnsibleError("failed to transfer file to %s" % out_path)
 
     def _connect_sftp(self):
-        cache_key = "%s__%s__" % (self.host, self.user)
+        cache_key = self._cache_key()
         if cache_key in SFTP_CONNECTION_CACHE:
             return SFTP_CONNECTION_CACHE[cache_key]
         else:
@@ -272,12 +380,25 @@ class Connection(object):
             raise errors.AnsibleError("failed to transfer file from %s" % in_path)
 
     def _any_keys_added(self):
-        added_any = False        
-        for hostname, keys in self.ssh._host_keys.iteritems():
-            for keytype, key in keys.iteritems():
-                added_this_time = getattr(key, '_added_by_ansible_this_time', False)
-                if added_this_time:
-                    return True
+        return bool(self._added_keys)
+
+    def _load_system_host_keys(self):
+        ''' reload known_hosts, reusing the previous parse if the file has not changed since '''
+        try:
+            st = os.stat(self.keyfile)
+        except OSError:
+            return
+        stamp = (st.st_mtime, st.st_size)
+        cached = SYSTEM_HOST_KEYS_CACHE.get(self.keyfile)
+        if cached is None or cached[0] != stamp:
+            cached = SYSTEM_HOST_KEYS_CACHE[self.keyfile] = (stamp, paramiko.HostKeys(self.keyfile))
+        self.ssh._system_host_keys = cached[1]
+
+    def _any_keys_unsaved(self):
+        ''' whether any key added this run is still missing from the loaded known_hosts '''
+        for (hostname, keytype, key) in self._added_keys:
+            if not self.ssh._system_host_keys.check(hostname, key):
+                return True
         return False
 
     def _save_ssh_host_keys(self, filename):
@@ -289,30 +410,59 @@ class Connection(object):
         if not self._any_keys_added():
             return False
 
-        path = os.path.expanduser("~/.ssh")
+        path = os.path.join(HOME_DIR, ".ssh")
         if not os.path.exists(path):
             os.makedirs(path)
 
-        f = open(filename, 'w')
-        for hostname, keys in self.ssh._host_keys.iteritems():
-            for keytype, key in keys.iteritems():
-                # was f.write
-                added_this_time = getattr(key, '_added_by_ansible_this_time', False)
-                if not added_this_time:
-                    f.write("%s %s %s\n" % (hostname, keytype, key.get_base64()))
-        for hostname, keys in self.ssh._host_keys.iteritems():
-            for keytype, key in keys.iteritems():
-                added_this_time = getattr(key, '_added_by_ansible_this_time', False)
-                if added_this_time:
-                    f.write("%s %s %s\n" % (hostname, keytype, key.get_base64()))
-        f.close()
+        # walk the parsed entries directly, HostKeys.iteritems() does a full
+        # scan of the file (hashing hashed hostnames) for every hostname
+        old_lines = []
+        known = set()
+        for entry in self.ssh._system_host_keys._entries:
+            if entry.key is None:
+                continue
+            keytype = entry.key.get_name()
+            for hostname in entry.hostnames:
+                known.add((hostname, keytype))
+                old_lines.append("%s %s %s\n" % (hostname, keytype, entry.key.get_base64()))
+        new_lines = [ "%s %s %s\n" % (hostname, keytype, key.get_base64())
+                      for (hostname, keytype, key) in self._added_keys
+                      if (hostname, keytype) not in known ]
+
+        # replace the file a symlinked known_hosts points at, not the link
+        filename = os.path.realpath(filename)
+        try:
+            key_stat = os.stat(filename)
+        except OSError:
+            key_stat = None
+
+        # write to a temporary file next to the real one and rename it into
+        # place, so an interrupted run can't leave a truncated known_hosts
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.known_hosts')
+        f = os.fdopen(fd, 'w', 65536)
+        try:
+            if key_stat is not None:
+                os.fchmod(fd, stat.S_IMODE(key_stat.st_mode))
+                try:
+                    os.fchown(fd, key_stat.st_uid, key_stat.st_gid)
+                except OSError:
+                    # not ours to give away, the file simply ends up owned by us
+                    pass
+            f.write("".join(old_lines))
+            f.write("".join(new_lines))
+            f.close()
+            os.rename(tmp_path, filename)
+        except:
+            f.close()
+            os.unlink(tmp_path)
+            raise
 
     def close(self):
         ''' terminate the connection '''
-        cache_key = self._cache_key()
-        SSH_CONNECTION_CACHE.pop(cache_key, None)
-        SFTP_CONNECTION_CACHE.pop(cache_key, None)
-        if self.sftp is not None:
+        (ssh, sftp) = _uncache(self._cache_key())
+        if sftp is not None:
+            sftp.close()
+        if self.sftp is not None and self.sftp is not sftp:
             self.sftp.close()
 
         if C.PARAMIKO_RECORD_HOST_KEYS and self._any_keys_added():
@@ -324,18 +474,19 @@ class Connection(object):
                 os.makedirs(dirname)
 
             KEY_LOCK = open(lockfile, 'w')
-            fcntl.lockf(KEY_LOCK, fcntl.LOCK_EX)
-            try:
-                # just in case any were added recently
-                self.ssh.load_system_host_keys()
-                self.ssh._host_keys.update(self.ssh._system_host_keys)
-                self._save_ssh_host_keys(self.keyfile)
-            except:
-                # unable to save keys, including scenario when key was invalid
-                # and caught earlier
-                traceback.print_exc()
-                pass
-            fcntl.lockf(KEY_LOCK, fcntl.LOCK_UN)
+            with _lockf(KEY_LOCK):
+                try:
+                    # just in case any were added recently
+                    self._load_system_host_keys()
+                    # another fork may have recorded the same keys while we were
+                    # waiting for the lock, in which case there is nothing to do
+                    if self._any_keys_unsaved():
+                        self._save_ssh_host_keys(self.keyfile)
+                except:
+                    # unable to save keys, including scenario when key was invalid
+                    # and caught earlier
+                    traceback.print_exc()
+                    pass
 
         self.ssh.close()
         
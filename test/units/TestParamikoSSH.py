@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from nose.plugins.skip import SkipTest
+
+from ansible import constants as C
+from ansible.runner.connection_plugins import paramiko_ssh
+
+try:
+    import paramiko
+    HAS_PARAMIKO = True
+except ImportError:
+    HAS_PARAMIKO = False
+
+class FakeSSHClient(object):
+
+    def __init__(self):
+        self._system_host_keys = paramiko.HostKeys()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestParamikoSSH(TestCase):
+
+    def setUp(self):
+        if not HAS_PARAMIKO:
+            raise SkipTest
+        self.tmpdir = tempfile.mkdtemp()
+        self.keyfile = os.path.join(self.tmpdir, 'known_hosts')
+        self.old_record_host_keys = C.PARAMIKO_RECORD_HOST_KEYS
+        C.PARAMIKO_RECORD_HOST_KEYS = True
+
+        self.key1 = paramiko.RSAKey.generate(1024)
+        self.key2 = paramiko.RSAKey.generate(1024)
+        self.key3 = paramiko.RSAKey.generate(1024)
+        self.hashed = paramiko.HostKeys.hash_host('hashed.example.com')
+
+        f = open(self.keyfile, 'w')
+        f.write("one.example.com,two.example.com ssh-rsa %s\n" % self.key1.get_base64())
+        f.write("%s ssh-rsa %s\n" % (self.hashed, self.key2.get_base64()))
+        f.write("old.example.com ssh-rsa %s\n" % self.key2.get_base64())
+        f.close()
+        os.chmod(self.keyfile, 0640)
+
+    def tearDown(self):
+        C.PARAMIKO_RECORD_HOST_KEYS = self.old_record_host_keys
+        shutil.rmtree(self.tmpdir)
+
+    def _connection(self, added_keys):
+        conn = paramiko_ssh.Connection(None, 'new.example.com', 22, 'root', None, None)
+        conn.ssh = FakeSSHClient()
+        conn.keyfile = self.keyfile
+        conn._added_keys = added_keys
+        return conn
+
+    def _read_keyfile(self):
+        data = open(self.keyfile).read()
+        data = data.replace(self.key1.get_base64(), 'KEY1')
+        data = data.replace(self.key2.get_base64(), 'KEY2')
+        data = data.replace(self.key3.get_base64(), 'KEY3')
+        return data
+
+    def test_save_ssh_host_keys(self):
+        conn = self._connection([
+            ('new.example.com', 'ssh-rsa', self.key3),
+            ('old.example.com', 'ssh-rsa', self.key3),
+        ])
+        conn._load_system_host_keys()
+        conn._save_ssh_host_keys(self.keyfile)
+
+        # existing entries are kept, one line per hostname, and keys added
+        # this run go at the bottom unless the host is already recorded
+        assert self._read_keyfile() == (
+            "one.example.com ssh-rsa KEY1\n"
+            "two.example.com ssh-rsa KEY1\n"
+            "%s ssh-rsa KEY2\n"
+            "old.example.com ssh-rsa KEY2\n"
+            "new.example.com ssh-rsa KEY3\n" % self.hashed)
+        assert os.stat(self.keyfile).st_mode & 0777 == 0640
+        assert os.listdir(self.tmpdir) == ['known_hosts']
+
+    def test_save_ssh_host_keys_through_symlink(self):
+        link = os.path.join(self.tmpdir, 'known_hosts_link')
+        os.symlink(self.keyfile, link)
+        conn = self._connection([ ('new.example.com', 'ssh-rsa', self.key3) ])
+        conn.keyfile = link
+        conn._load_system_host_keys()
+        conn._save_ssh_host_keys(link)
+
+        assert os.path.islink(link)
+        assert self._read_keyfile().endswith("new.example.com ssh-rsa KEY3\n")
+
+    def test_close_without_new_keys(self):
+        before = os.stat(self.keyfile)
+        conn = self._connection([])
+        conn.close()
+
+        after = os.stat(self.keyfile)
+        assert conn.ssh.closed
+        assert (after.st_ino, after.st_mtime) == (before.st_ino, before.st_mtime)
+
+    def test_close_with_keys_already_saved(self):
+        conn = self._connection([ ('new.example.com', 'ssh-rsa', self.key3) ])
+        conn.close()
+        saved = os.stat(self.keyfile)
+
+        # a later connection that added the same key has nothing to write
+        conn = self._connection([ ('new.example.com', 'ssh-rsa', self.key3) ])
+        conn.close()
+
+        after = os.stat(self.keyfile)
+        assert (after.st_ino, after.st_mtime) == (saved.st_ino, saved.st_mtime)
+        assert self._read_keyfile().count("new.example.com") == 1